@@ -1,13 +1,25 @@
 #! /usr/bin/env python
 
 """ j2cli main file """
-import pkg_resources
 
 __author__  = "Manolis Stamatogiannakis"
 __email__   = "mstamat@gmail.com"
-__version__ = pkg_resources.get_distribution('j2cli').version
 
-from j2cli.cli import render, dependencies
+def __getattr__(name):
+    # resolve the version lazily, only when it is actually needed (e.g. -V)
+    if name == '__version__':
+        try:
+            from importlib.metadata import version
+        except ImportError:
+            from importlib_metadata import version
+        return version('j2cli')
+    # j2cli.render/j2cli.dependencies, kept for compatibility - the console scripts use j2cli.cli
+    if name in ('render', 'dependencies'):
+        from j2cli import cli
+        globals()[name] = getattr(cli, name)
+        return globals()[name]
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
 if __name__ == '__main__':
+    from j2cli.cli import render
     render()
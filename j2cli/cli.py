@@ -1,19 +1,12 @@
 import io, os, sys
 import argparse
+import functools
 import logging
-from functools import reduce
-
-import jinja2
-import jinja2.meta
-import jinja2.loaders
-from . import __version__
-
-import imp, inspect
 
+from .defaults import UNDEFINED
 from .context import FORMATS
-from .context import parse_data_spec, read_context_data, dict_update_deep
-from .extras import filters
-from .extras.customize import CustomizationModule
+from .context import parse_data_specs, read_context_data, dict_update_deep, environ_snapshot
+from .extras.customize import CustomizationModule, load_module
 
 # available log levels, adjusted with -v at command line
 LOGLEVELS = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
@@ -21,100 +14,81 @@ LOGLEVELS = [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
 # format to use for logging
 LOGFORMAT = '%(levelname)s: %(message)s'
 
-# map keywords to to Jinja2 error handlers
-UNDEFINED = {
-    'strict': jinja2.StrictUndefined, # raises errors for undefined variables
-    'normal': jinja2.Undefined,       # can be printed/iterated - error on other operations
-    'debug': jinja2.DebugUndefined,   # return the debug info when printed
-}
-
-class FilePathLoader(jinja2.BaseLoader):
-    """ Custom Jinja2 template loader which just loads a single template file """
-
-    def __init__(self, cwd, encoding='utf-8'):
-        self.cwd = cwd
-        self.encoding = encoding
-
-    def get_source(self, environment, template):
-        # Path
-        filename = os.path.join(self.cwd, template)
+# minimum number of templates for analyzing dependencies in parallel
+DEPENDENCIES_PARALLEL_MIN = 4
 
-        # Read
-        try:
-            with io.open(template, 'rt', encoding=self.encoding) as f:
-                contents = f.read()
-        except IOError:
-            raise jinja2.TemplateNotFound(template)
-
-        # Finish
-        uptodate = lambda: False
-        return contents, filename, uptodate
+def version_string():
+    """ Version information for j2cli and Jinja2 """
+    import jinja2
+    from . import __version__
+    return 'j2cli {0}, Jinja2 {1}'.format(__version__, jinja2.__version__)
 
+class VersionAction(argparse.Action):
+    """ Prints version information and exits. Unlike argparse's stock version action,
+        the version string is only computed (importing Jinja2) when the option is used.
+    """
 
-class Jinja2TemplateRenderer(object):
-    """ Template renderer """
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+            help="show program's version number and exit"):
+        super(VersionAction, self).__init__(option_strings=option_strings,
+                dest=dest, default=default, nargs=0, help=help)
 
-    ENABLED_EXTENSIONS=(
-        'jinja2.ext.i18n',
-        'jinja2.ext.do',
-        'jinja2.ext.loopcontrols',
-    )
+    def __call__(self, parser, namespace, values, option_string=None):
+        print(version_string())
+        parser.exit()
 
-    def __init__(self, cwd, undefined='strict', no_compact=False, j2_env_params={}):
-        # Custom env params
-        j2_env_params.setdefault('keep_trailing_newline', True)
-        j2_env_params.setdefault('undefined', UNDEFINED[undefined])
-        j2_env_params.setdefault('trim_blocks', not no_compact)
-        j2_env_params.setdefault('lstrip_blocks', not no_compact)
-        j2_env_params.setdefault('extensions', self.ENABLED_EXTENSIONS)
-        j2_env_params.setdefault('loader', FilePathLoader(cwd))
-
-        # Environment
-        self._env = jinja2.Environment(**j2_env_params)
-        self._env.globals.update(dict(
-            env=filters.env
-        ))
-
-    def register_filters(self, filters):
-        self._env.filters.update(filters)
-
-    def register_tests(self, tests):
-        self._env.tests.update(tests)
-
-    def import_filters(self, filename):
-        self.register_filters(self._import_functions(filename))
-
-    def import_tests(self, filename):
-        self.register_tests(self._import_functions(filename))
-
-    def _import_functions(self, filename):
-        m = imp.load_source('imported-funcs', filename)
-        return dict((name, func) for name, func in inspect.getmembers(m) if inspect.isfunction(func))
-
-    def render(self, template_path, context):
-        """ Render a template
-        :param template_path: Path to the template file
-        :type template_path: basestring
-        :param context: Template data
-        :type context: dict
-        :return: Rendered template
-        :rtype: basestring
-        """
-        return self._env \
-            .get_template(template_path) \
-            .render(context) \
-            .encode('utf-8')
-
-
-def render_command(argv):
-    """ Pure render command
+def _add_undefined_hint(e, argv, data, dspecs):
+    """ Add a hint about piping data files to an UndefinedError, when applicable.
+    :param e: Error raised while rendering.
+    :type e: jinja2.exceptions.UndefinedError
     :param argv: Command-line arguments
     :type argv: list
-    :return: Rendered template
-    :rtype: basestring
+    :param data: Data specifications, as given in the command-line arguments
+    :type data: list
+    :param dspecs: Parsed data specifications
+    :type dspecs: list
+    """
+    # Only when the environment is the sole data source - a .env file may have been meant instead
+    if len(dspecs) != 1 or dspecs[0][0] is not None or not e.args:
+        return
+    # When there's data at stdin, tell the user they should read it from '-'
+    try:
+        stdin_has_data = sys.stdin is not None and not sys.stdin.isatty()
+    except (AttributeError, ValueError):
+        # stdin replaced with something file-like, or closed
+        stdin_has_data = False
+    if not stdin_has_data:
+        return
+
+    # Suggested command: the environment spec is replaced by stdin, keeping its ctx_dst and format
+    args = argv[1:]
+    del args[len(args) - 1 - args[::-1].index(data[0])]
+    if '--' not in args:
+        # specs starting with '-' must come after '--'
+        args.append('--')
+    args.append('-' + data[0])
+    extra_info = (
+        "\n\n"
+        "If you're trying to pipe a .env file, please run me with '-' as the data source:\n"
+        "$ {cmd} {argv}".format(cmd=os.path.basename(argv[0]), argv=' '.join(args))
+    )
+    e.args = (e.args[0] + extra_info,) + e.args[1:]
+
+def _stream_with_hint(chunks, argv, data, dspecs):
+    """ Pass through the chunks of a streamed template, adding the hint to UndefinedErrors """
+    import jinja2
+    try:
+        for chunk in chunks:
+            yield chunk
+    except jinja2.exceptions.UndefinedError as e:
+        _add_undefined_hint(e, argv, data, dspecs)
+        raise
+
+@functools.lru_cache(maxsize=1)
+def _build_parser():
+    """ Argument parser for the render command - built once, argparse parsers can be reused
+    :rtype: argparse.ArgumentParser
     """
-    version_info = (__version__, jinja2.__version__)
-    formats_names = list(FORMATS.keys())
     parser = argparse.ArgumentParser(
         description='Command-line interface to Jinja2 for templating in shell scripts.',
         epilog='',
@@ -125,8 +99,7 @@ def render_command(argv):
     p_custom = parser.add_argument_group('customization options')
 
     ### optional arguments ##########################################
-    parser.add_argument('-V', '--version', action='version',
-            version='j2cli {0}, Jinja2 {1}'.format(*version_info))
+    parser.add_argument('-V', '--version', action=VersionAction)
     parser.add_argument('-v', '--verbose', action='count', default=0,
             help='Increase verbosity.')
     ### input options ###############################################
@@ -137,6 +110,8 @@ def render_command(argv):
             'The different sources will be squashed into a singled dict. '
             'The format is <source>:<context_dest>:<format>. '
             'Parts of the specification that are not needed can be ommitted. '
+            'Leave out the source and use the env format (e.g. :env or :<context_dest>:env) '
+            'to read the environment variables. '
             'See examples at the end of the help.')
     p_input.add_argument('-U', '--undefined', default='strict',
             dest='undefined', choices=UNDEFINED.keys(),
@@ -144,7 +119,7 @@ def render_command(argv):
     p_input.add_argument('-I', '--ignore-missing', action='store_true',
             help='Ignore any missing data files.')
     p_input.add_argument('-f', '--fallback-format',
-            default='ini', choices=formats_names,
+            default='ini', choices=FORMATS.keys(),
             help='Specify fallback data format. '
             'Used for data with no specified format and no appropriate extension.')
     ### output options ##############################################
@@ -162,71 +137,92 @@ def render_command(argv):
     p_custom.add_argument('--customize', default=None,
             metavar='python-file', dest='customize',
             help='Load custom j2cli behavior from a Python file.')
+    return parser
+
+def render_command(argv, stream=False):
+    """ Pure render command
+    :param argv: Command-line arguments
+    :type argv: list
+    :param stream: Return the rendered template incrementally, as an iterator over its chunks.
+                   Ignored when the output is written to a file.
+    :type stream: bool
+    :return: Rendered template
+    :rtype: basestring|iterator
+    """
+    # version probes are common in scripts - answer them without building the parser
+    if argv[1:] in (['-V'], ['--version']):
+        print(version_string())
+        return b''
 
+    parser = _build_parser()
     args = parser.parse_args(argv[1:])
     logging.basicConfig(format=LOGFORMAT, level=LOGLEVELS[min(args.verbose, len(LOGLEVELS)-1)])
     logging.debug("Parsed arguments: %s", args)
 
     # Parse data specifications
-    dspecs = [parse_data_spec(d, fallback_format=args.fallback_format) for d in args.data]
+    dspecs = parse_data_specs(args.data, fallback_format=args.fallback_format)
 
     # Customization
     if args.customize is not None:
         customize = CustomizationModule(
-            imp.load_source('customize-module', args.customize)
+            load_module('customize_module', args.customize)
         )
     else:
         customize = CustomizationModule(None)
 
-    # Read data based on specs
-    data = [read_context_data(*dspec, args.ignore_missing) for dspec in dspecs]
+    # Read data based on specs - each source is read when it's merged
+    data = (read_context_data(*dspec, args.ignore_missing) for dspec in dspecs)
 
-    # Squash data into a single context
-    context = reduce(dict_update_deep, data, {})
+    # Squash data into a single context - the first source is updated in place
+    context = next(data, {})
+    if context is os.environ:
+        context = environ_snapshot().copy()
+    for d in data:
+        dict_update_deep(context, d)
 
     # Apply final customizations
     context = customize.alter_context(context)
 
     # Renderer
-    renderer = Jinja2TemplateRenderer(os.getcwd(), args.undefined, args.no_compact, j2_env_params=customize.j2_environment_params())
+    import jinja2
+    from .render import Jinja2TemplateRenderer
+    # copied - the hook may return a dict of its own, or a read-only mapping
+    j2_env_params = dict(customize.j2_environment_params())
+    if args.filters or args.tests or args.customize is not None:
+        # custom filters/tests applied to literals are evaluated at compile time -
+        # don't persist their results, unless the customization module asks for a cache
+        j2_env_params.setdefault('bytecode_cache', None)
+    renderer = Jinja2TemplateRenderer(os.getcwd(), args.undefined, args.no_compact, j2_env_params=j2_env_params)
     customize.j2_environment(renderer._env)
 
-    # Filters, Tests
-    renderer.register_filters(filters.EXTRA_FILTERS)
+    # Filters, Tests - merged first, later sources take precedence
+    extra_filters = {}
     for fname in args.filters:
-        renderer.import_filters(fname)
-    for fname in args.tests:
-        renderer.import_tests(fname)
+        extra_filters.update(renderer.load_functions(fname))
+    extra_filters.update(customize.extra_filters())
+    renderer.register_filters(extra_filters)
 
-    renderer.register_filters(customize.extra_filters())
-    renderer.register_tests(customize.extra_tests())
+    extra_tests = {}
+    for fname in args.tests:
+        extra_tests.update(renderer.load_functions(fname))
+    extra_tests.update(customize.extra_tests())
+    renderer.register_tests(extra_tests)
 
     # Render
     try:
-        result = renderer.render(args.template, context)
+        if stream and not args.output_file:
+            # Undefined errors show up while iterating over the chunks
+            result = _stream_with_hint(renderer.stream(args.template, context), argv, args.data, dspecs)
+        else:
+            result = renderer.render_bytes(args.template, context)
     except jinja2.exceptions.UndefinedError as e:
-        # When there's data at stdin, tell the user they should use '-'
-        try:
-            stdin_has_data = stdin is not None and not stdin.isatty()
-            if args.format == 'env' and args.data == None and stdin_has_data:
-                extra_info = (
-                    "\n\n"
-                    "If you're trying to pipe a .env file, please run me with a '-' as the data file name:\n"
-                    "$ {cmd} {argv} -".format(cmd=os.path.basename(sys.argv[0]), argv=' '.join(sys.argv[1:]))
-                )
-                e.args = (e.args[0] + extra_info,) + e.args[1:]
-        except:
-            # The above code is so optional that any, ANY, error, is ignored
-            pass
-
-        # Proceed
+        _add_undefined_hint(e, argv, args.data, dspecs)
         raise
 
     # -o
     if args.output_file:
-        with io.open(args.output_file, 'wt', encoding='utf-8') as f:
-            f.write(result.decode('utf-8'))
-            f.close()
+        with io.open(args.output_file, 'wb') as f:
+            f.write(result)
         return b''
 
     # Finish
@@ -236,16 +232,40 @@ def render_command(argv):
 def render():
     """ CLI entry point for rendering templates. """
     try:
-        output = render_command(sys.argv)
+        output = render_command(sys.argv, stream=True)
     except SystemExit:
         return 1
     outstream = getattr(sys.stdout, 'buffer', sys.stdout)
-    outstream.write(output)
+    if isinstance(output, bytes):
+        outstream.write(output)
+    else:
+        for chunk in output:
+            outstream.write(chunk)
+
+
+def template_dependencies(filename, source=None):
+    """ Find the templates referenced by a template file.
+    :param filename: Path to the template file
+    :type filename: str
+    :param source: Contents of the template, if already read (e.g. from stdin)
+    :type source: str|None
+    :return: (filename, referenced templates)
+    :rtype: tuple
+    """
+    import jinja2
+    import jinja2.meta
+    from .render import Jinja2TemplateRenderer
+
+    env = jinja2.Environment(extensions=Jinja2TemplateRenderer.ENABLED_EXTENSIONS)
+    if source is None:
+        with io.open(filename, 'rt', encoding='utf-8') as f:
+            source = f.read()
+    ast = env.parse(source)
+    return filename, list(jinja2.meta.find_referenced_templates(ast))
 
 
 def dependencies():
     """ CLI entry point for analyzing template dependencies. """
-    version_info = (__version__, jinja2.__version__)
     parser = argparse.ArgumentParser(
         description='Analyze Jinja2 templates for dependencies.',
         epilog='',
@@ -255,9 +275,30 @@ def dependencies():
             type=argparse.FileType('r', encoding='utf-8'))
     args = parser.parse_args()
 
-    env = jinja2.Environment(extensions=Jinja2TemplateRenderer.ENABLED_EXTENSIONS)
+    # templates with a path are opened by argparse only to validate them, and are
+    # re-opened by path when analyzed - others (stdin) can only be read here
+    filenames = []
+    sources = {}
     for tpl in args.templates:
-            ast = env.parse(tpl.read())
-            print(tpl)
-            print(list(jinja2.meta.find_referenced_templates(ast)))
-            # note recursive!
+        filenames.append(tpl.name)
+        if tpl is sys.stdin:
+            if tpl.name not in sources:
+                sources[tpl.name] = tpl.read()
+        else:
+            tpl.close()
+    paths = [f for f in filenames if f not in sources]
+
+    if len(paths) < DEPENDENCIES_PARALLEL_MIN:
+        results = dict(map(template_dependencies, paths))
+    else:
+        # parsing is pure Python - use processes to get around the GIL
+        from concurrent.futures import ProcessPoolExecutor
+        workers = min(len(paths), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = dict(executor.map(template_dependencies, paths, chunksize=4))
+    results.update(template_dependencies(f, source) for f, source in sources.items())
+
+    for filename in filenames:
+        print(filename)
+        print(results[filename])
+        # note recursive!
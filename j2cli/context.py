@@ -1,17 +1,11 @@
-import six
+import io
 import os
 import sys
-import six
 import re
+import functools
+import importlib.util
 import logging
-import platform
-import collections
-
-# Adjust for aliases removed in python 3.8
-try:
-    collectionsAbc = collections.abc
-except AttributeError:
-    collectionsAbc = collections
+import collections.abc
 
 #region Parsers
 
@@ -32,25 +26,14 @@ def _parse_ini(data_string):
         $ j2 config.j2 data.ini
         $ cat data.ini | j2 --format=ini config.j2
     """
-    from io import StringIO
-
-    # Override
-    class MyConfigParser(ConfigParser.ConfigParser):
-        def as_dict(self):
-            """ Export as dict
-            :rtype: dict
-            """
-            d = dict(self._sections)
-            for k in d:
-                d[k] = dict(self._defaults, **d[k])
-                d[k].pop('__name__', None)
-            return d
-
-    # Parse
-    ini = MyConfigParser()
-    ini.readfp(ini_file_io(data_string))
+    ini = _ini_parser_class()()
+    ini.read_file(io.StringIO(data_string))
+    return ini.as_dict()
 
-    # Export
+def _parse_ini_file(f):
+    """ INI data input from a binary file object. """
+    ini = _ini_parser_class()()
+    ini.read_file(io.TextIOWrapper(f, encoding='utf-8'))
     return ini.as_dict()
 
 def _parse_json(data_string):
@@ -73,7 +56,23 @@ def _parse_json(data_string):
         $ j2 config.j2 data.json
         $ cat data.json | j2 --format=ini config.j2
     """
-    return json.loads(data_string)
+    return _json_module().loads(data_string)
+
+def _parse_json_file(f):
+    """ JSON data input from a binary file object.
+    Large files are parsed incrementally with [ijson](https://pypi.org/project/ijson/),
+    when it's installed with one of its C backends.
+    """
+    if os.fstat(f.fileno()).st_size >= JSON_INCREMENTAL_MIN_SIZE:
+        ijson = _ijson_module()
+        if ijson is not None:
+            try:
+                return next(ijson.items(f, '', use_float=True))
+            except ijson.JSONError:
+                # e.g. integers beyond 64 bits, or NaN/Infinity - json accepts them,
+                # and reports the errors of actually invalid files
+                f.seek(0)
+    return _json_module().load(f)
 
 def _parse_yaml(data_string):
     """ YAML data input format.
@@ -92,16 +91,12 @@ def _parse_yaml(data_string):
         $ j2 config.j2 data.yml
         $ cat data.yml | j2 --format=yaml config.j2
     """
-    # Loader
-    try:
-        # PyYAML 5.1 supports FullLoader
-        Loader = yaml.FullLoader
-    except AttributeError:
-        # Have to use SafeLoader for older versions
-        Loader = yaml.SafeLoader
-    # Done
+    yaml, Loader = _yaml_module()
     return yaml.load(data_string, Loader=Loader)
 
+# KEY=value lines of a dotenv file, with surrounding whitespace stripped
+_ENV_LINE_RE = re.compile(r'^[^\S\n]*([^=\s#][^=\n]*?)[^\S\n]*=[^\S\n]*(.*?)[^\S\n]*$', re.M)
+
 def _parse_env(data_string):
     """ Data input from environment variables.
 
@@ -127,16 +122,8 @@ def _parse_env(data_string):
         $ j2 config.j2 - < data.env
     """
     # Parse
-    if isinstance(data_string, six.string_types):
-        data = dict(filter(
-            lambda l: len(l) == 2 ,
-            (
-                list(map(
-                    str.strip,
-                    line.split('=', 1)
-                ))
-                for line in data_string.split("\n"))
-        ))
+    if isinstance(data_string, str):
+        data = dict(_ENV_LINE_RE.findall(data_string))
     else:
         data = data_string
 
@@ -151,6 +138,14 @@ FORMATS = {
     'env': _parse_env
 }
 
+# parsers of formats that can read directly from a binary file object - decoding is
+# left to the parser, which is much faster for libyaml
+FORMATS_STREAM = {
+    'ini': _parse_ini_file,
+    'json': _parse_json_file,
+    'yaml': _parse_yaml,
+}
+
 FORMATS_ALIASES = dict(zip(FORMATS.keys(), FORMATS.keys()))
 FORMATS_ALIASES.update({
     'yml': 'yaml',
@@ -162,33 +157,105 @@ FORMATS_ALIASES.update({
 
 #region Imports
 
-# JSON: simplejson | json
-try:
-    import simplejson as json
-except ImportError:
+# JSON: simplejson | json - imported on first use
+@functools.lru_cache(maxsize=None)
+def _json_module():
     try:
+        import simplejson as json
+    except ImportError:
         import json
+    return json
+
+# JSON data files at least this large are parsed incrementally, if possible
+JSON_INCREMENTAL_MIN_SIZE = 1 << 20
+
+# ijson - optional, imported on first use
+@functools.lru_cache(maxsize=None)
+def _ijson_module():
+    try:
+        import ijson
     except ImportError:
-         del FORMATS['json']
-
-# INI: Python 2 | Python 3
-try:
-    import ConfigParser
-    from io import BytesIO as ini_file_io
-except ImportError:
-    import configparser as ConfigParser
-    from io import StringIO as ini_file_io
-
-# YAML
-try:
+        return None
+    # the pure Python backend is much slower than loading the whole file
+    if ijson.backend == 'python':
+        return None
+    return ijson
+
+# INI - imported on first use, the parser class is only defined once
+@functools.lru_cache(maxsize=None)
+def _ini_parser_class():
+    import configparser
+
+    class IniParser(configparser.ConfigParser):
+        def as_dict(self):
+            """ Export as dict
+            :rtype: dict
+            """
+            d = {k: dict(self._defaults, **v) for k, v in self._sections.items()}
+            for v in d.values():
+                v.pop('__name__', None)
+            return d
+
+    return IniParser
+
+# YAML - imported on first use, only its availability is checked here
+@functools.lru_cache(maxsize=None)
+def _yaml_module():
+    """ PyYAML module and the loader to use with it
+    :rtype: tuple
+    """
     import yaml
-except ImportError:
+    if hasattr(yaml, 'FullLoader'):
+        # PyYAML 5.1 supports FullLoader
+        names = ('CFullLoader', 'FullLoader')
+    else:
+        # Have to use SafeLoader for older versions
+        names = ('CSafeLoader', 'SafeLoader')
+    # the libyaml-based loaders are much faster, when PyYAML was built with them
+    Loader = getattr(yaml, names[0], None) or getattr(yaml, names[1])
+    return yaml, Loader
+
+if importlib.util.find_spec('yaml') is None:
     del FORMATS['yaml']
+    del FORMATS_STREAM['yaml']
 
 #endregion
 
+# buffer size for reading data files - parsers reading from the file object do many small reads
+DATA_READ_BUFSIZE = 64 * 1024
+
+# sentinel for missing dict keys
+_MISSING = object()
+
+# windows paths start with a drive letter (e.g. 'c:\\foo.json')
+_IS_WINDOWS = sys.platform == 'win32'
+_WIN_DRIVE_RE = re.compile(r'^[a-z]$', re.I)
+
+# last environment snapshot: (raw os.environ data, decoded dict)
+_environ_cache = (None, None)
+
+def environ_snapshot():
+    """ Copy of the environment variables as a dict.
+    Decoding the environment is the expensive part of copying it, so the copy is
+    shared until the environment changes. It must not be modified.
+    :rtype: dict
+    """
+    global _environ_cache
+    raw = getattr(os.environ, '_data', None)
+    if raw is None:
+        # not a CPython os._Environ
+        return dict(os.environ)
+    cached_raw, snapshot = _environ_cache
+    if raw != cached_raw:
+        snapshot = dict(os.environ)
+        _environ_cache = (raw.copy(), snapshot)
+    return snapshot
+
 def dict_update_deep(d, u):
-    """ Performs a deep update of d with data from u.
+    """ Performs an in-place deep update of d with data from u.
+    Mappings of u that don't exist in d are not copied, but added to d as-is.
+    Nested mappings of d are copied before being updated, as they may be shared
+    (e.g. YAML aliases, or mappings added as-is from an earlier update).
     :param d: Dictionary to be updated.
     :type dict: dict
     :param u: Dictionary with updates to be applied.
@@ -196,48 +263,61 @@ def dict_update_deep(d, u):
     :return: Updated version of d.
     :rtype: dict
     """
-    for k, v in six.iteritems(u):
-        dv = d.get(k, {})
-        if not isinstance(dv, collectionsAbc.Mapping):
-            d[k] = v
-        elif isinstance(v, collectionsAbc.Mapping):
-            d[k] = dict_update_deep(dv, v)
-        else:
-            d[k] = v
+    stack = [(d, u)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in src.items():
+            dv = dst.get(k, _MISSING)
+            # plain dicts are checked first - isinstance against the ABC is slower
+            if (dv is not _MISSING
+                    and (type(dv) is dict or isinstance(dv, collections.abc.Mapping))
+                    and (type(v) is dict or isinstance(v, collections.abc.Mapping))):
+                # shallow copy - only the mappings on the path to an update are copied
+                dst[k] = dv = dict(dv)
+                stack.append((dv, v))
+            else:
+                dst[k] = v
     return d
 
 def parse_data_spec(dspec, fallback_format='ini'):
     """ Parse a data file specification.
     :param dspec: Data file specification in format <location>[:<ctx_dst>][:<format>].
+                  An empty location with an explicit env format (e.g. ':env', ':dst:env')
+                  stands for the environment variables. A plain 'env' is a file name.
     :type dspec: str
     :param fallback_format: Format to fallback to if no format is set/guessed.
     :type fallback_format: str
-    :return: (location, ctx_dest, format)
+    :return: (location, ctx_dest, format) - location is None for the environment variables
     :rtype: tuple
     """
     source = ctx_dst = fmt = None
+    aliases = FORMATS_ALIASES
+    # whether the format was explicitly set to env - only then an empty location means the environment
+    env_explicit = False
 
     ### set fmt ###########################################
     # manually specified format
     if fmt is None:
         left, delim, right = dspec.rpartition(':')
-        if left != '' and right in FORMATS_ALIASES:
+        if delim != '' and right in aliases and (left != '' or aliases[right] == 'env'):
             source = left
-            fmt = FORMATS_ALIASES[right]
+            fmt = aliases[right]
+            env_explicit = fmt == 'env'
     # guess format by extension
     if fmt is None or right == '?':
-        left, delim, right = dspec.rpartition('.')
-        if left != '' and right in FORMATS_ALIASES:
+        left, delim, ext = dspec.rpartition('.')
+        ext = ext.lower()
+        if left != '' and ext in aliases:
             source = dspec
-            fmt = FORMATS_ALIASES[right]
+            fmt = aliases[ext]
     # use fallback format
     if fmt is None:
         source = dspec
-        fmt = FORMATS_ALIASES[fallback_format]
+        fmt = aliases[fallback_format]
 
     ### set ctx_dst #######################################
     left, delim, right = source.rpartition(':')
-    if platform.system() == 'Windows' and re.match(r'^[a-z]$', left, re.I):
+    if _IS_WINDOWS and _WIN_DRIVE_RE.match(left):
         # windows path (e.g. 'c:\foo.json') -- ignore split
         pass
     elif left != '' and right != '':
@@ -247,13 +327,34 @@ def parse_data_spec(dspec, fallback_format='ini'):
     elif left != '' and right == '':
         # empty ctx_dst (e.g. '/data/foo:1.json:) -- used when source contains ':'
         source = left
+    elif left == '' and delim != '' and env_explicit:
+        # environment with ctx_dst (e.g. ':dst:env'), or an empty one (e.g. '::env')
+        source = left
+        ctx_dst = right or None
     else:
         # no ctx_dst specified
         pass
 
+    ### no location with explicit env format: read environment ###
+    if source == '' and env_explicit:
+        source = None
+
     ### return ############################################
     return (source, ctx_dst, fmt)
 
+def parse_data_specs(dspecs, fallback_format='ini'):
+    """ Parse a list of data file specifications.
+    :param dspecs: Data file specifications, see parse_data_spec().
+    :type dspecs: list
+    :param fallback_format: Format to fallback to if no format is set/guessed.
+    :type fallback_format: str
+    :return: List of (location, ctx_dest, format) tuples
+    :rtype: list
+    """
+    # resolve the fallback once for all specs
+    fallback_format = FORMATS_ALIASES[fallback_format]
+    return [parse_data_spec(dspec, fallback_format) for dspec in dspecs]
+
 def read_context_data(source, ctx_dst, fmt, ignore_missing=False):
     """ Read context data into a dictionary
     :param source: Source file to read from.
@@ -268,36 +369,41 @@ def read_context_data(source, ctx_dst, fmt, ignore_missing=False):
                            an empty context rather than raising an error.
     :type ignore_missing: bool|False
     :return: Dictionary with the context data.
-    :rtype: dict
+             When reading the environment to the top-level, this is os.environ itself
+             and should not be modified.
+    :rtype: dict|os._Environ
     """
     logging.debug("Reading data: source=%s, ctx_dst=%s, fmt=%s", source, ctx_dst, fmt)
 
+    context = data = _MISSING
+
     # Special case: environment variables
     if source == '-':
         # read data from stdin
         data = sys.stdin.read()
     elif source is not None:
-        # read data from file
+        # read data from file - parsed from the file object when the format allows it
         try:
-            with open(source, 'r') as sourcef:
-                data = sourcef.read()
+            with open(source, 'rb', buffering=DATA_READ_BUFSIZE) as sourcef:
+                if fmt in FORMATS_STREAM:
+                    context = FORMATS_STREAM[fmt](sourcef)
+                else:
+                    data = sourcef.read().decode('utf-8')
         except FileNotFoundError as e:
             if ignore_missing:
                 logging.warning('skipping missing input data file "%s"', source)
                 return {}
             else:
                 raise e
-    else:
-        data = None
-
-    if data is None and fmt == env:
-        # load environment to context dict
-        if sys.version_info[0] > 2:
-            context = os.environ.copy()
-        else:
-            # python2: encode environment variables as unicode
-            context = dict((k.decode('utf-8'), v.decode('utf-8')) for k, v in os.environ.items())
-    elif data is not None:
+    if context is not _MISSING:
+        # already parsed
+        pass
+    elif data is _MISSING and fmt == 'env':
+        # load environment to context dict - not copied, unless it gets nested
+        if ctx_dst is None:
+            return os.environ
+        context = environ_snapshot().copy()
+    elif data is not _MISSING:
         # parse data to context dict
         context = FORMATS[fmt](data)
     else:
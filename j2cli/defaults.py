@@ -0,0 +1,8 @@
+""" j2cli defaults """
+
+# map keywords to to Jinja2 error handlers (names of jinja2 classes)
+UNDEFINED = {
+    'strict': 'StrictUndefined', # raises errors for undefined variables
+    'normal': 'Undefined',       # can be printed/iterated - error on other operations
+    'debug': 'DebugUndefined',   # return the debug info when printed
+}
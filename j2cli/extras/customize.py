@@ -1,3 +1,26 @@
+import importlib.machinery
+import importlib.util
+import sys
+
+def load_module(name, filename):
+    """ Load a Python source file as a module.
+    The module is added to sys.modules, replacing any module with the same name.
+    :param name: Name of the loaded module.
+    :type name: str
+    :param filename: Path to the Python source file.
+    :type filename: str
+    :return: The loaded module.
+    :rtype: module
+    """
+    # explicit loader, so that files without a .py suffix can be loaded too
+    # going through the loader's exec_module() reuses/writes __pycache__ bytecode
+    loader = importlib.machinery.SourceFileLoader(name, filename)
+    spec = importlib.util.spec_from_file_location(name, filename, loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    # registered like a regular import, so that it can be found by name (e.g. by pickle)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
 class CustomizationModule(object):
     """ The interface for customization functions, defined as module-level functions """
@@ -1,10 +1,14 @@
 """ Additional Jinja2 filters """
+import functools
 import os
 import re
 import sys
+import types
 from jinja2 import is_undefined, contextfilter
 from jinja2.exceptions import UndefinedError
 
+from ..context import environ_snapshot
+
 if sys.version_info >= (3,0):
     from shutil import which
 elif sys.version_info >= (2,5):
@@ -19,6 +23,9 @@ elif sys.version_info >= (2,7):
 else:
     assert False, "Unsupported Python version: %s" % sys.version_info
 
+# docker link uri regex - no colons in proto/port keeps matching linear
+_DOCKER_LINK_RE = re.compile(r'(?P<proto>[^:]+)://' r'(?P<addr>.+):' r'(?P<port>[^:]+)$')
+
 def docker_link(value, format='{addr}:{port}'):
     """ Given a Docker Link environment variable value, format it into something else.
         XXX: The name of the filter is not very informative. This is actually a partial URI parser.
@@ -50,13 +57,12 @@ def docker_link(value, format='{addr}:{port}'):
         return value
 
     # Parse the value
-    m = re.match(r'(?P<proto>.+)://' r'(?P<addr>.+):' r'(?P<port>.+)$', value)
+    m = _DOCKER_LINK_RE.match(value)
     if not m:
         raise ValueError('The provided value does not seems to be a Docker link: {0}'.format(value))
-    d = m.groupdict()
 
     # Format
-    return format.format(**d)
+    return format.format_map(m.groupdict())
 
 
 def env(varname, default=None):
@@ -85,37 +91,61 @@ def env(varname, default=None):
         ```
 
         Notice that there must be quotes around the environment variable name
+
+        The values of the variables are those at the time j2 started rendering.
     """
+    return _env_lookup(os.environ, varname, default)
+
+def _env_lookup(environ, varname, default=None):
+    """ env(), looking up the variable in environ """
     if default is not None:
         # With the default, there's never an error
-        return os.getenv(varname, default)
+        return environ.get(varname, default)
     else:
         # Raise KeyError when not provided
-        return os.environ[varname]
+        return environ[varname]
 
-def align_suffix(text, delim, column=None, spaces_after_delim=1):
-    """ Align the suffixes of lines in text, starting from the specified delim.
+def frozen_env(environ=None):
+    """ Create a version of env() that looks up variables in a snapshot of environ
+        (os.environ by default), taken when frozen_env() is called.
+        Lookups in a plain dict avoid the encoding/decoding done by os.environ.
     """
-    s=''
-
-    if column is None or column == 'auto':
-        column = max(map(lambda l: l.find(delim), text.splitlines()))
-    elif column == 'previous':
-        column = align_suffix.column_previous
+    snapshot = environ_snapshot() if environ is None else dict(environ)
+    return functools.partial(_env_lookup, snapshot)
 
-    for l in map(lambda s: s.split(delim, 1), text.splitlines()):
+def _align_suffix_core(lines, delim, column, spaces_after_delim):
+    """ Align the suffixes of a list of lines.
+    :return: Aligned lines, each ending with a line separator.
+    :rtype: list
+    """
+    nl = os.linesep
+    pad = spaces_after_delim*' '
+    parts = []
+    for l in lines:
+        l = l.split(delim, 1)
         if len(l) < 2:
             # no delimiter occurs
-            s += l[0].rstrip() + os.linesep
+            parts.append(l[0].rstrip() + nl)
         elif l[0].strip() == '':
             # no content before delimiter - leave as-is
-            s += l[0] + delim + l[1] + os.linesep
+            parts.append(l[0] + delim + l[1] + nl)
         else:
             # align
-            s += l[0].rstrip().ljust(column) + delim + spaces_after_delim*' ' + l[1].strip() + os.linesep
+            parts.append(l[0].rstrip().ljust(column) + delim + pad + l[1].strip() + nl)
+    return parts
+
+def align_suffix(text, delim, column=None, spaces_after_delim=1):
+    """ Align the suffixes of lines in text, starting from the specified delim.
+    """
+    lines = text.splitlines()
+
+    if column is None or column == 'auto':
+        column = max(l.find(delim) for l in lines)
+    elif column == 'previous':
+        column = align_suffix.column_previous
 
     align_suffix.column_previous = column
-    return s
+    return ''.join(_align_suffix_core(lines, delim, column, spaces_after_delim))
 
 align_suffix.column_previous = None
 
@@ -124,12 +154,15 @@ align_suffix.column_previous = None
 def ctxlookup(context, key):
     """ Lookup the value of a key in the template context.
     """
-    v = context
     try:
+        if '.' not in key:
+            # fast path for top-level names
+            return context[key]
+        v = context
         for k in key.split('.'):
             v = v[k]
         return v
-    except KeyError:
+    except (KeyError, TypeError):
         return context.environment.undefined(name=key)
 
 def sh_opt(text, name, delim=" ", quote=False):
@@ -146,22 +179,88 @@ def sh_optq(text, name, delim=" "):
     """
     return sh_opt(text, name, delim, quote=True)
 
-# Filters to be loaded
-EXTRA_FILTERS = {
+def sh_expand(text):
+    """ Expand the user home directory and environment variables in text.
+    """
+    return os.path.expandvars(os.path.expanduser(text))
+
+def ifelse(t, truev, falsev):
+    """ Return truev if t is true, falsev otherwise.
+    """
+    return truev if t else falsev
+
+_ONOFF = ('off', 'on')
+_YESNO = ('no', 'yes')
+
+def onoff(t):
+    """ Format a boolean as 'on'/'off'.
+    """
+    return _ONOFF[bool(t)]
+
+def yesno(t):
+    """ Format a boolean as 'yes'/'no'.
+    """
+    return _YESNO[bool(t)]
+
+def maybe_njit(func):
+    """ Decorator for JIT-compiling numeric custom filters with [Numba](https://numba.pydata.org/).
+
+    Meant to be used in files loaded with `--filters`:
+
+    ```python
+    from j2cli.extras.filters import maybe_njit
+
+    @maybe_njit
+    def checksum(n):
+        ...
+    ```
+
+    When Numba is not installed, the function is used as-is.
+    Compiling a function may take several seconds, so the compiled code is cached
+    on disk and only the first render pays for it.
+    Only functions that Numba can compile in nopython mode will work.
+    """
+    try:
+        from numba import njit
+    except ImportError:
+        return func
+    compiled = njit(cache=True, nogil=True)(func)
+
+    # wrap in a plain function, so that it is picked up by --filters/--tests
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return compiled(*args, **kwargs)
+    return wrapper
+
+def volatile(func):
+    """ Wrap a filter whose result depends on more than its arguments (environment,
+        filesystem, state), so that Jinja2 never evaluates it at compile time.
+        Otherwise, e.g. `"VAR"|env` would be baked into the cached template bytecode.
+        Can also be used for custom filters.
+    """
+    # Jinja2 does not constant-fold filters that take the context
+    @contextfilter
+    @functools.wraps(func)
+    def wrapper(context, *args, **kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+
+# Filters to be loaded (read-only, shared by all renderers)
+EXTRA_FILTERS = types.MappingProxyType({
     'sh_quote': sh_quote,
-    'sh_which': which,
-    'sh_expand': lambda s: os.path.expandvars(os.path.expanduser(s)),
-    'sh_expanduser': os.path.expanduser,
-    'sh_expandvars': os.path.expandvars,
-    'sh_realpath': os.path.realpath,
+    'sh_which': volatile(which),
+    'sh_expand': volatile(sh_expand),
+    'sh_expanduser': volatile(os.path.expanduser),
+    'sh_expandvars': volatile(os.path.expandvars),
+    'sh_realpath': volatile(os.path.realpath),
     'sh_opt': sh_opt,
     'sh_optq': sh_optq,
-    'ifelse': lambda t, truev, falsev: truev if t else falsev,
-    'onoff': lambda t: 'on' if t else 'off',
-    'yesno': lambda t: 'yes' if t else 'no',
+    'ifelse': ifelse,
+    'onoff': onoff,
+    'yesno': yesno,
     'docker_link': docker_link,
-    'env': env,
-    'align_suffix': align_suffix,
+    'env': volatile(env),
+    'align_suffix': volatile(align_suffix),
     'ctxlookup': ctxlookup,
-}
+})
 
@@ -0,0 +1,231 @@
+""" Jinja2 template rendering """
+import io, os
+import functools
+import mmap
+import stat
+import types
+import zlib
+
+import jinja2
+import jinja2.bccache
+import jinja2.loaders
+
+from .defaults import UNDEFINED
+from .extras import filters
+from .extras.customize import load_module
+
+# environment variable that overrides the bytecode cache directory
+# setting it to an empty string disables the cache
+BYTECODE_CACHE_ENVVAR = 'J2CLI_BYTECODE_CACHE'
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """ Filesystem bytecode cache whose keys also cover the Environment settings that
+        change the compiled code (e.g. trim_blocks/lstrip_blocks, set by --no-compact)
+    """
+
+    # Environment attributes that affect how templates are compiled
+    COMPILE_SETTINGS = (
+        'block_start_string', 'block_end_string',
+        'variable_start_string', 'variable_end_string',
+        'comment_start_string', 'comment_end_string',
+        'line_statement_prefix', 'line_comment_prefix',
+        'trim_blocks', 'lstrip_blocks', 'newline_sequence', 'keep_trailing_newline',
+        'optimized', 'autoescape',
+    )
+
+    def compile_settings_key(self, environment):
+        """ Checksum of the compile-affecting settings of an environment
+        :param environment: Environment the template is compiled in
+        :type environment: jinja2.Environment
+        :rtype: str
+        """
+        settings = []
+        for name in self.COMPILE_SETTINGS:
+            value = getattr(environment, name, None)
+            # callable autoescape is evaluated at render time - only its presence matters
+            settings.append('<callable>' if callable(value) else repr(value))
+        settings.append(repr(sorted(environment.extensions)))
+        return '{0:08x}'.format(zlib.crc32('\0'.join(settings).encode('utf-8')))
+
+    def get_bucket(self, environment, name, filename, source):
+        """ Cache bucket for a template, keyed on its name and the environment's compile settings """
+        key = '{0}-{1}'.format(self.get_cache_key(name, filename), self.compile_settings_key(environment))
+        bucket = jinja2.bccache.Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+def bytecode_cache():
+    """ Create the cache used to persist compiled templates across runs.
+    The default location is a per-user temporary directory picked by Jinja2.
+    :return: Bytecode cache, or None if caching has been disabled.
+    :rtype: BytecodeCache|None
+    """
+    directory = os.environ.get(BYTECODE_CACHE_ENVVAR)
+    if directory == '':
+        return None
+    if directory is not None and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # include Jinja2 version in the cache keys - bytecode is not portable across versions
+    pattern = 'j2cli-{0}-%s.cache'.format(jinja2.__version__)
+    return BytecodeCache(directory=directory, pattern=pattern)
+
+@functools.lru_cache(maxsize=32)
+def _load_functions(filename, mtime):
+    """ Load the public top-level functions of a Python file.
+    Cached by absolute path and modification time, so that files aren't executed again
+    until they change.
+    :rtype: types.MappingProxyType
+    """
+    # stable name per file - modules are registered in sys.modules
+    name = 'imported-funcs-{0:08x}'.format(zlib.crc32(filename.encode('utf-8')))
+    m = load_module(name, filename)
+    # public top-level functions defined in the file only - _names are helpers of the file itself,
+    # and imported functions (e.g. the maybe_njit decorator) are not filters/tests
+    return types.MappingProxyType({k: v for k, v in vars(m).items()
+            if isinstance(v, types.FunctionType) and not k.startswith('_')
+            and v.__module__ == m.__name__})
+
+class FilePathLoader(jinja2.BaseLoader):
+    """ Custom Jinja2 template loader which just loads a single template file """
+
+    # templates at least this large are memory-mapped (pipes always report a size of 0)
+    MMAP_MIN_SIZE = 64 * 1024
+
+    def __init__(self, cwd, encoding='utf-8'):
+        self.cwd = cwd
+        self.encoding = encoding
+
+    def get_source(self, environment, template):
+        # Path
+        filename = os.path.join(self.cwd, template)
+
+        # Read - binary mode, the Jinja2 lexer normalizes newlines anyway
+        try:
+            with io.open(filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                size = st.st_size
+                if size >= self.MMAP_MIN_SIZE:
+                    # decode straight from the mapped file, without copying it to a buffer first
+                    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                        contents = str(mm, self.encoding)
+                else:
+                    contents = f.read().decode(self.encoding)
+        except IOError:
+            raise jinja2.TemplateNotFound(template)
+
+        # Finish - the loaded template is reused by Jinja2 for as long as the file isn't modified
+        if stat.S_ISREG(st.st_mode):
+            mtime = st.st_mtime_ns
+            def uptodate():
+                try:
+                    return os.stat(filename).st_mtime_ns == mtime
+                except OSError:
+                    return False
+        else:
+            # pipes can't be read twice
+            uptodate = lambda: False
+        return contents, filename, uptodate
+
+
+class Jinja2TemplateRenderer(object):
+    """ Template renderer """
+
+    ENABLED_EXTENSIONS=(
+        'jinja2.ext.i18n',
+        'jinja2.ext.do',
+        'jinja2.ext.loopcontrols',
+    )
+
+    # Jinja2 environment parameters that don't depend on the renderer arguments
+    _DEFAULT_ENV_PARAMS = types.MappingProxyType(dict(
+        keep_trailing_newline=True,
+        extensions=ENABLED_EXTENSIONS,
+    ))
+
+    def __init__(self, cwd, undefined='strict', no_compact=False, j2_env_params=None, freeze_env=True):
+        # Env params - custom params take precedence, the caller's dict is not modified
+        j2_env_params = j2_env_params or {}
+        params = dict(self._DEFAULT_ENV_PARAMS,
+            undefined=getattr(jinja2, UNDEFINED[undefined]),
+            trim_blocks=not no_compact,
+            lstrip_blocks=not no_compact,
+            loader=FilePathLoader(cwd),
+        )
+        if 'bytecode_cache' not in j2_env_params:
+            params['bytecode_cache'] = bytecode_cache()
+        params.update(j2_env_params)
+
+        # Environment
+        self._env = jinja2.Environment(**params)
+        self._env.filters.update(filters.EXTRA_FILTERS)
+
+        # env() - by default, sees the environment variables at the time of construction
+        if freeze_env:
+            env = filters.frozen_env()
+            self._env.filters['env'] = filters.volatile(env)
+        else:
+            env = filters.env
+        self._env.globals['env'] = env
+
+    def register_filters(self, filters):
+        self._env.filters.update(filters)
+
+    def register_tests(self, tests):
+        self._env.tests.update(tests)
+
+    def import_filters(self, filename):
+        self.register_filters(self.load_functions(filename))
+
+    def import_tests(self, filename):
+        self.register_tests(self.load_functions(filename))
+
+    def load_functions(self, filename):
+        """ Load the top-level functions of a Python file
+        :param filename: Path to the Python file
+        :type filename: basestring
+        :return: Functions of the file, by name
+        :rtype: dict
+        """
+        filename = os.path.abspath(filename)
+        return dict(_load_functions(filename, os.stat(filename).st_mtime_ns))
+
+    def render(self, template_path, context):
+        """ Render a template
+        :param template_path: Path to the template file
+        :type template_path: basestring
+        :param context: Template data
+        :type context: dict
+        :return: Rendered template
+        :rtype: str
+        """
+        return self._env \
+            .get_template(template_path) \
+            .render(context)
+
+    def render_bytes(self, template_path, context):
+        """ Render a template to UTF-8 encoded bytes
+        :param template_path: Path to the template file
+        :type template_path: basestring
+        :param context: Template data
+        :type context: dict
+        :return: Rendered template
+        :rtype: bytes
+        """
+        return self.render(template_path, context).encode('utf-8')
+
+    def stream(self, template_path, context, buffer_size=64):
+        """ Render a template incrementally
+        :param template_path: Path to the template file
+        :type template_path: basestring
+        :param context: Template data
+        :type context: dict
+        :param buffer_size: Number of template output items to buffer in each chunk
+        :type buffer_size: int
+        :return: Iterator over the chunks of the rendered template
+        :rtype: iterator
+        """
+        stream = self._env \
+            .get_template(template_path) \
+            .stream(context)
+        stream.enable_buffering(buffer_size)
+        return (chunk.encode('utf-8') for chunk in stream)
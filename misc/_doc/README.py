@@ -15,9 +15,11 @@ README = {
         for name, f in j2cli.context.FORMATS.items()
     },
     'extras': {
+        # only the registered filters - the module also has helpers (e.g. volatile, frozen_env)
         'filters': {k: doc(v)
                     for k, v in getmembers(j2cli.extras.filters)
-                    if inspect.isfunction(v) and inspect.getmodule(v) is j2cli.extras.filters}
+                    if inspect.isfunction(v) and inspect.getmodule(v) is j2cli.extras.filters
+                    and k in j2cli.extras.filters.EXTRA_FILTERS}
     }
 }
 
@@ -18,16 +18,12 @@ and [kolypto/j2cli](https://github.com/kolypto/j2cli).
 from setuptools import setup, find_packages
 import sys
 
-# PyYAML 3.11 was the last to support Python 2.6
-# This code limits pyyaml version for older pythons
-pyyaml_version = 'pyyaml >= 3.10'  # fresh
-if sys.version_info[:2] == (2, 6):
-    pyyaml_version = 'pyyaml<=3.11'
+pyyaml_version = 'pyyaml >= 3.13'  # first to support Python 3.7
 
 # Extra packages for compatibility across Python versions.
 packages_compat = []
-if sys.version_info < (3,0):
-    packages_compat.append('shutilwhich>=1.1')
+if sys.version_info < (3,8):
+    packages_compat.append('importlib_metadata')
 
 setup(
     name='j2cli',
@@ -46,17 +42,18 @@ setup(
     scripts=[],
     entry_points={
         'console_scripts': [
-            'j2 = j2cli:render',
-            'j2dep = j2cli:dependencies',
+            'j2 = j2cli.cli:render',
+            'j2dep = j2cli.cli:dependencies',
         ]
     },
+    python_requires='>=3.7',
     install_requires=[
         'jinja2 >= 2.7.2',
-        'six >= 1.10',
         packages_compat,
     ],
     extras_require={
-        'yaml': [pyyaml_version,]
+        'yaml': [pyyaml_version,],
+        'ijson': ['ijson >= 3.1',],
     },
     include_package_data=True,
     zip_safe=False,
@@ -70,7 +67,7 @@ setup(
         'Operating System :: OS Independent',
         'Topic :: Software Development',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
 )
@@ -3,49 +3,125 @@
 from __future__ import unicode_literals
 
 import unittest
+import functools
+import importlib, importlib.util
+import itertools
+import shutil
 import os, sys, io, os.path, tempfile
-from copy import copy
-from contextlib import contextmanager
+from contextlib import contextmanager, redirect_stdout, ExitStack
 from jinja2.exceptions import UndefinedError
 
-from j2cli.cli import render_command
+from j2cli.cli import render_command, dependencies, DEPENDENCIES_PARALLEL_MIN
+from j2cli.context import parse_data_spec, environ_snapshot, JSON_INCREMENTAL_MIN_SIZE
+from j2cli.render import BYTECODE_CACHE_ENVVAR, Jinja2TemplateRenderer
+
+# only look for PyYAML here - it is imported by the tests that run
+HAS_YAML = importlib.util.find_spec('yaml') is not None
+HAS_IJSON = importlib.util.find_spec('ijson') is not None
+
+# temporary files are kept in memory where possible, unless $TMPDIR says otherwise
+if 'TMPDIR' not in os.environ and os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+    TMPDIR = '/dev/shm'
+else:
+    TMPDIR = None
+
+# directory holding the temporary files of the running test class
+tmpdir = None
+_tmpnames = ('f{0}'.format(n) for n in itertools.count())
+
+@functools.lru_cache(maxsize=None)
+def _read_text(path):
+    """ Contents of a resource file, read only once per test run """
+    with io.open(path, 'rt', encoding='utf-8') as fp:
+        return fp.read()
 
 @contextmanager
 def mktemp(contents):
     """ Create a temporary file with the given contents, and yield its path """
-    _, path = tempfile.mkstemp()
-    fp = io.open(path, 'wt+', encoding='utf-8')
-    fp.write(contents)
-    fp.flush()
-    try:
-        yield path
-    finally:
-        fp.close()
-        os.unlink(path)
+    path = os.path.join(tmpdir, next(_tmpnames))
+    with io.open(path, 'wb') as fp:
+        fp.write(contents.encode('utf-8'))
+    yield path
 
 
 @contextmanager
 def mock_environ(new_env):
-    old_env = copy(os.environ)
+    """ Set environment variables for the duration of the context, restoring only those """
+    # copy(os.environ) would share its underlying data with os.environ itself
+    old_env = {k: os.environ.get(k) for k in new_env}
     os.environ.update(new_env)
-    yield
-    os.environ.clear()
-    os.environ.update(old_env)
+    try:
+        yield
+    finally:
+        for k, v in old_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+@contextmanager
+def mock_modules(**modules):
+    """ Replace modules in sys.modules for the duration of the context (None makes imports fail) """
+    old_modules = {name: sys.modules.get(name) for name in modules}
+    sys.modules.update(modules)
+    try:
+        yield
+    finally:
+        for name, module in old_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+@contextmanager
+def mock_stdin(stdin):
+    """ Replace sys.stdin for the duration of the context (with an empty stream by default) """
+    old_stdin = sys.stdin
+    sys.stdin = io.StringIO('') if stdin is None else stdin
+    try:
+        yield
+    finally:
+        sys.stdin = old_stdin
 
 
 class RenderTest(unittest.TestCase):
-    def setUp(self):
-        os.chdir(
-            os.path.dirname(__file__)
-        )
+    @classmethod
+    def setUpClass(cls):
+        # import the renderer and parsers once, rather than in whichever test uses them first
+        for name in ('jinja2', 'j2cli.render', 'configparser', 'json') + (('yaml',) if HAS_YAML else ()):
+            importlib.import_module(name)
+        # temporary files are removed along with their directory, when the class is done
+        global tmpdir
+        tmpdir = tempfile.mkdtemp(dir=TMPDIR)
+        # templates are throwaway temp files - don't fill the bytecode cache with them
+        cls._bytecode_cache = os.environ.get(BYTECODE_CACHE_ENVVAR)
+        os.environ[BYTECODE_CACHE_ENVVAR] = ''
+        # resources are referred to relative to the tests directory - no test changes directory
+        cls._cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if cls._bytecode_cache is None:
+            os.environ.pop(BYTECODE_CACHE_ENVVAR, None)
+        else:
+            os.environ[BYTECODE_CACHE_ENVVAR] = cls._bytecode_cache
+        os.chdir(cls._cwd)
 
     def _testme(self, argv, expected_output, stdin=None, env=None):
         """ Helper test shortcut """
-        with mock_environ(env or {}):
-            result = render_command(os.getcwd(), env or {}, stdin, argv)
-        if isinstance(result, bytes):
-            result = result.decode('utf-8')
-        self.assertEqual(result, expected_output)
+        with mock_environ(env or {}), mock_stdin(stdin):
+            result = render_command(['j2'] + argv)
+        # compare bytes with bytes, rather than decoding every result
+        if isinstance(result, bytes) and not isinstance(expected_output, bytes):
+            expected_output = expected_output.encode('utf-8')
+        elif isinstance(expected_output, bytes) and not isinstance(result, bytes):
+            expected_output = expected_output.decode('utf-8')
+        # the assertion (and its diff) is only needed on a mismatch
+        if result != expected_output:
+            self.assertEqual(result, expected_output)
 
     #: The expected output
     expected_output = """server {
@@ -59,150 +135,272 @@ class RenderTest(unittest.TestCase):
   error_log  /var/log/nginx//http.error.log;
 }
 """
+    expected_output_bytes = expected_output.encode('utf-8')
 
     def _testme_std(self, argv, stdin=None, env=None):
-        self._testme(argv, self.expected_output, stdin, env)
+        self._testme(argv, self.expected_output_bytes, stdin, env)
+
+    def _testme_std_cases(self, cases, env=None):
+        """ Run _testme_std() for each (argv, stdin file name) case, as a subtest """
+        for argv, stdin_name in cases:
+            with self.subTest(argv=argv, stdin=stdin_name):
+                stdin = None if stdin_name is None else io.StringIO(_read_text(stdin_name))
+                self._testme_std(argv, stdin=stdin, env=env)
 
     def test_ini(self):
-        # Filename
-        self._testme_std(['resources/nginx.j2', 'resources/data.ini'])
-        # Format
-        self._testme_std(['--format=ini', 'resources/nginx.j2', 'resources/data.ini'])
-        # Stdin
-        self._testme_std(['--format=ini', 'resources/nginx.j2'], stdin=open('resources/data.ini'))
-        self._testme_std(['--format=ini', 'resources/nginx.j2', '-'], stdin=open('resources/data.ini'))
+        self._testme_std_cases([
+            # Filename
+            (['resources/nginx.j2', 'resources/data.ini'], None),
+            # Format
+            (['resources/nginx.j2', 'resources/data.ini:ini'], None),
+            # Stdin
+            (['resources/nginx.j2', '--', '-:ini'], 'resources/data.ini'),
+            (['--fallback-format=ini', 'resources/nginx.j2', '-'], 'resources/data.ini'),
+        ])
 
     def test_json(self):
-        # Filename
-        self._testme_std(['resources/nginx.j2', 'resources/data.json'])
-        # Format
-        self._testme_std(['--format=json', 'resources/nginx.j2', 'resources/data.json'])
-        # Stdin
-        self._testme_std(['--format=json', 'resources/nginx.j2'], stdin=open('resources/data.json'))
-        self._testme_std(['--format=json', 'resources/nginx.j2', '-'], stdin=open('resources/data.json'))
+        self._testme_std_cases([
+            # Filename
+            (['resources/nginx.j2', 'resources/data.json'], None),
+            # Format
+            (['resources/nginx.j2', 'resources/data.json:json'], None),
+            # Stdin
+            (['resources/nginx.j2', '--', '-:json'], 'resources/data.json'),
+            (['--fallback-format=json', 'resources/nginx.j2', '-'], 'resources/data.json'),
+        ])
+
+    def test_json__large(self):
+        """ Test JSON files large enough to be parsed incrementally """
+        if not HAS_IJSON:
+            raise unittest.SkipTest('ijson not installed')
+
+        padding = '"pad": "{0}"'.format('x' * JSON_INCREMENTAL_MIN_SIZE)
+        with mktemp('{{ a }}/{{ b }}') as template:
+            for data, expected in (
+                    ('{"a": 1, "b": 1.5, %s}', '1/1.5'),
+                    # not supported by ijson, parsed by json instead
+                    ('{"a": 12345678901234567890, "b": NaN, %s}', '12345678901234567890/nan'),
+                    ('{"a": -Infinity, "b": Infinity, %s}', '-inf/inf'),
+                    ):
+                with self.subTest(data=data), mktemp(data % padding) as json_file:
+                    self._testme([template, json_file + ':json'], expected)
+            # invalid files are still reported as such
+            with mktemp('{"a": 1, %s' % padding) as json_file:
+                with self.assertRaises(ValueError):
+                    self._testme([template, json_file + ':json'], '')
 
     def test_yaml(self):
-        try:
-            import yaml
-        except ImportError:
+        if not HAS_YAML:
+            raise unittest.SkipTest('Yaml lib not installed')
+
+        self._testme_std_cases([
+            # Filename
+            (['resources/nginx.j2', 'resources/data.yml'], None),
+            (['resources/nginx.j2', 'resources/data.yaml'], None),
+            # Format
+            (['resources/nginx.j2', 'resources/data.yml:yaml'], None),
+            # Stdin
+            (['resources/nginx.j2', '--', '-:yaml'], 'resources/data.yml'),
+            (['--fallback-format=yaml', 'resources/nginx.j2', '-'], 'resources/data.yml'),
+        ])
+
+    def test_yaml__aliases(self):
+        """ Test that updating an aliased mapping from another source leaves the other aliases alone """
+        if not HAS_YAML:
             raise unittest.SkipTest('Yaml lib not installed')
 
-        # Filename
-        self._testme_std(['resources/nginx.j2', 'resources/data.yml'])
-        self._testme_std(['resources/nginx.j2', 'resources/data.yaml'])
-        # Format
-        self._testme_std(['--format=yaml', 'resources/nginx.j2', 'resources/data.yml'])
-        # Stdin
-        self._testme_std(['--format=yaml', 'resources/nginx.j2'], stdin=open('resources/data.yml'))
-        self._testme_std(['--format=yaml', 'resources/nginx.j2', '-'], stdin=open('resources/data.yml'))
+        with mktemp('base: &b {port: 1}\nx: *b\ny: *b\n') as yml_file, mktemp('{"x": {"port": 2}}') as json_file:
+            with mktemp('{{ x.port }}/{{ y.port }}/{{ base.port }}') as template:
+                self._testme([template, yml_file + ':yaml', json_file + ':json'], '2/1/1')
+                # the aliases may also come from a source that is merged into an earlier one
+                self._testme([template, json_file + ':json', yml_file + ':yaml', json_file + ':json'], '2/1/1')
 
     def test_env(self):
-        # Filename
-        self._testme_std(['--format=env', 'resources/nginx-env.j2', 'resources/data.env'])
-        self._testme_std([                'resources/nginx-env.j2', 'resources/data.env'])
-        # Format
-        self._testme_std(['--format=env', 'resources/nginx-env.j2', 'resources/data.env'])
-        self._testme_std([                'resources/nginx-env.j2', 'resources/data.env'])
-        # Stdin
-        self._testme_std(['--format=env', 'resources/nginx-env.j2', '-'], stdin=open('resources/data.env'))
-        self._testme_std([                'resources/nginx-env.j2', '-'], stdin=open('resources/data.env'))
+        self._testme_std_cases([
+            # Filename
+            (['resources/nginx-env.j2', 'resources/data.env'], None),
+            # Format
+            (['resources/nginx-env.j2', 'resources/data.env:env'], None),
+            (['--fallback-format=env', 'resources/nginx-env.j2', 'resources/data.env'], None),
+            # Stdin
+            (['resources/nginx-env.j2', '--', '-:env'], 'resources/data.env'),
+            (['--fallback-format=env', 'resources/nginx-env.j2', '-'], 'resources/data.env'),
+        ])
 
         # Environment!
-        # In this case, it's not explicitly provided, but implicitly gotten from the environment
+        # In this case, it's not read from a file, but from the environment variables
         env = dict(NGINX_HOSTNAME='localhost', NGINX_WEBROOT='/var/www/project', NGINX_LOGS='/var/log/nginx/')
-        self._testme_std(['--format=env', 'resources/nginx-env.j2'], env=env)
-        self._testme_std([                'resources/nginx-env.j2'], env=env)
+        self._testme_std_cases([
+            (['resources/nginx-env.j2', ':env'], None),
+            (['resources/nginx-env.j2', 'resources/data.json', ':env'], None),
+        ], env=env)
+
+    def test_env_file__comments(self):
+        # Test that comments, lines without a key and blank lines are skipped, and whitespace is stripped
+        with mktemp('{{ A }}/{{ B }}/{{ C }}/{{ D|default("-") }}') as template:
+            with mktemp('# A=comment\nA=1\n\n  B = 2  \n=3\n  # C=comment\nC=x#y\nD\n') as context:
+                self._testme([template, context + ':env'], '1/2/x#y/-')
 
     def test_import_env(self):
         # Import environment into a variable
         with mktemp('{{ a }}/{{ env.B }}') as template:
             with mktemp('{"a":1}') as context:
-                self._testme(['--format=json', '--import-env=env', template, context], '1/2', env=dict(B='2'))
-        # Import environment into global scope
+                self._testme([template, context + ':json', ':env:env'], '1/2', env=dict(B='2'))
+        # Import environment into global scope - later sources take precedence
         with mktemp('{{ a }}/{{ B }}') as template:
             with mktemp('{"a":1,"B":1}') as context:
-                self._testme(['--format=json', '--import-env=', template, context], '1/2', env=dict(B='2'))
+                self._testme([template, context + ':json', ':env'], '1/2', env=dict(B='2'))
 
     def test_env_file__equals_sign_in_value(self):
         # Test whether environment variables with "=" in the value are parsed correctly
         with mktemp('{{ A|default('') }}/{{ B }}/{{ C }}') as template:
             with mktemp('A\nB=1\nC=val=1\n') as context:
-                self._testme(['--format=env', template, context], '/1/val=1')
+                self._testme([template, context + ':env'], '/1/val=1')
 
     def test_unicode(self):
         # Test how unicode is handled
         # I'm using Russian language for unicode :)
         with mktemp('Проверка {{ a }} связи!') as template:
             with mktemp('{"a": "широкополосной"}') as context:
-                self._testme(['--format=json', template, context], 'Проверка широкополосной связи!')
+                self._testme([template, context + ':json'], 'Проверка широкополосной связи!')
 
         # Test case from issue #17: unicode environment variables
-        if sys.version_info[0] == 2:
-            # Python 2: environment variables are bytes
-            self._testme(['resources/name.j2'], u'Hello Jürgen!\n', env=dict(name=b'J\xc3\xbcrgen'))
-        else:
-            # Python 3: environment variables are unicode strings
-            self._testme(['resources/name.j2'], u'Hello Jürgen!\n', env=dict(name=u'Jürgen'))
+        self._testme(['resources/name.j2', ':env'], u'Hello Jürgen!\n', env=dict(name=u'Jürgen'))
 
     def test_filters__env(self):
+        if not HAS_YAML:
+            raise unittest.SkipTest('Yaml lib not installed')
+
         with mktemp('user_login: kolypto') as yml_file:
+            yml_spec = yml_file + ':yaml'
             with mktemp('{{ user_login }}:{{ "USER_PASS"|env }}') as template:
                 # Test: template with an env variable
-                self._testme(['--format=yaml', template, yml_file], 'kolypto:qwerty123', env=dict(USER_PASS='qwerty123'))
+                self._testme([template, yml_spec], 'kolypto:qwerty123', env=dict(USER_PASS='qwerty123'))
 
                 # environment cleaned up
                 assert 'USER_PASS' not in os.environ
 
                 # Test: KeyError
                 with self.assertRaises(KeyError):
-                    self._testme(['--format=yaml', template, yml_file], 'kolypto:qwerty123', env=dict())
+                    self._testme([template, yml_spec], 'kolypto:qwerty123', env=dict())
 
             # Test: default
             with mktemp('{{ user_login }}:{{ "USER_PASS"|env("-none-") }}') as template:
-                self._testme(['--format=yaml', template, yml_file], 'kolypto:-none-', env=dict())
+                self._testme([template, yml_spec], 'kolypto:-none-', env=dict())
 
             # Test: using as a function
             with mktemp('{{ user_login }}:{{ env("USER_PASS") }}') as template:
-                self._testme(['--format=yaml', template, yml_file], 'kolypto:qwerty123', env=dict(USER_PASS='qwerty123'))
+                self._testme([template, yml_spec], 'kolypto:qwerty123', env=dict(USER_PASS='qwerty123'))
 
                 with self.assertRaises(KeyError):
                     # Variable not set
-                    self._testme(['--format=yaml', template, yml_file], '', env=dict())
+                    self._testme([template, yml_spec], '', env=dict())
 
             # Test: using as a function, with a default
             with mktemp('{{ user_login }}:{{ env("USER_PASS", "-none-") }}') as template:
-                self._testme(['--format=yaml', template, yml_file], 'kolypto:qwerty123', env=dict(USER_PASS='qwerty123'))
-                self._testme(['--format=yaml', template, yml_file], 'kolypto:-none-', env=dict())
-
+                self._testme([template, yml_spec], 'kolypto:qwerty123', env=dict(USER_PASS='qwerty123'))
+                self._testme([template, yml_spec], 'kolypto:-none-', env=dict())
+
+
+    def test_filters__env_snapshot(self):
+        """ Test that env() sees the environment at the time the renderer is created """
+        with mktemp('{{ env("J2CLI_TEST_VAR", "-") }}/{{ "J2CLI_TEST_VAR"|env("-") }}') as template:
+            with mock_environ(dict(J2CLI_TEST_VAR='before')):
+                frozen = Jinja2TemplateRenderer(os.getcwd())
+                volatile = Jinja2TemplateRenderer(os.getcwd(), freeze_env=False)
+                os.environ['J2CLI_TEST_VAR'] = 'after'
+                self.assertEqual(frozen.render(template, {}), 'before/before')
+                self.assertEqual(volatile.render(template, {}), 'after/after')
+
+    def test_environ_snapshot(self):
+        """ Test that the environment snapshot is shared, until the environment changes """
+        snapshot = environ_snapshot()
+        self.assertIs(environ_snapshot(), snapshot)
+        self.assertEqual(snapshot, dict(os.environ))
+        with mock_environ(dict(J2CLI_TEST_VAR='1')):
+            changed = environ_snapshot()
+            self.assertIsNot(changed, snapshot)
+            self.assertEqual(changed['J2CLI_TEST_VAR'], '1')
+        self.assertNotIn('J2CLI_TEST_VAR', environ_snapshot())
 
     def test_custom_filters(self):
         with mktemp('{{ a|parentheses }}') as template:
-            self._testme(['--format=env', '--filters=resources/custom_filters.py', template], '(1)', env=dict(a='1'))
+            self._testme(['--filters=resources/custom_filters.py', template, ':env'], '(1)', env=dict(a='1'))
+
+    def test_custom_filters__maybe_njit(self):
+        """ Test custom filters decorated with maybe_njit() """
+        filters_file = (
+            'from j2cli.extras.filters import maybe_njit\n'
+            '@maybe_njit\n'
+            'def sq(n):\n'
+            '    return n * n\n'
+        )
+        with mktemp(filters_file) as filters, mktemp('{{ a|int|sq }}') as template:
+            # the imported decorator is not a filter itself
+            self.assertEqual(list(Jinja2TemplateRenderer(os.getcwd()).load_functions(filters)), ['sq'])
+            self._testme(['--filters=' + filters, template, ':env'], '9', env=dict(a='3'))
+
+    def test_maybe_njit__fallback(self):
+        """ Test that maybe_njit() leaves functions as they are when Numba is not installed """
+        import j2cli.extras.filters
+        sq = lambda n: n * n
+        with mock_modules(numba=None):
+            self.assertIs(j2cli.extras.filters.maybe_njit(sq), sq)
 
     def test_custom_tests(self):
         with mktemp('{% if a|int is custom_odd %}odd{% endif %}') as template:
-            self._testme(['--format=env', '--tests=resources/custom_tests.py', template], 'odd', env=dict(a='1'))
+            self._testme(['--tests=resources/custom_tests.py', template, ':env'], 'odd', env=dict(a='1'))
 
     def test_output_file(self):
         with mktemp('{{ a }}') as template:
-            try:
-                self._testme(['-o', '/tmp/j2-out', template], '', env=dict(a='123'))
-                self.assertEqual('123', io.open('/tmp/j2-out', 'r').read())
-            finally:
-                os.unlink('/tmp/j2-out')
+            # removed along with the other temporary files
+            output_file = os.path.join(tmpdir, 'j2-out')
+            self._testme(['-o', output_file, template, ':env'], '', env=dict(a='123'))
+            with io.open(output_file, 'r') as f:
+                self.assertEqual('123', f.read())
+
+    def test_stream(self):
+        """ Test rendering incrementally, as done for stdout """
+        chunks = render_command(['j2', 'resources/nginx.j2', 'resources/data.json'], stream=True)
+        self.assertNotIsInstance(chunks, bytes)
+        self.assertEqual(b''.join(chunks), self.expected_output_bytes)
+        # undefined variables are reported while iterating
+        with mock_environ(dict()), mock_stdin(None):
+            chunks = render_command(['j2', 'resources/name.j2', ':env'], stream=True)
+            with self.assertRaises(UndefinedError):
+                b''.join(chunks)
+        # streaming is not used for output files
+        output_file = os.path.join(tmpdir, 'j2-out-stream')
+        self.assertEqual(render_command(['j2', '-o', output_file, 'resources/nginx.j2', 'resources/data.json'], stream=True), b'')
+        with io.open(output_file, 'rb') as f:
+            self.assertEqual(f.read(), self.expected_output_bytes)
 
     def test_undefined(self):
         """ Test --undefined """
         # `name` undefined: error
-        self.assertRaises(UndefinedError, self._testme, ['resources/name.j2'], u'Hello !\n', env=dict())
+        self.assertRaises(UndefinedError, self._testme, ['resources/name.j2', ':env'], u'Hello !\n', env=dict())
         # `name` undefined: no error
-        self._testme(['--undefined', 'resources/name.j2'], u'Hello !\n', env=dict())
+        self._testme(['--undefined=normal', 'resources/name.j2', ':env'], u'Hello !\n', env=dict())
+
+    def test_undefined__stdin_hint(self):
+        """ Test the hint about piping .env files, shown for undefined variables """
+        stdin = lambda: io.StringIO('name=Jürgen\n')
+        # environment as the sole source, with data at stdin: hint to read it instead
+        with self.assertRaises(UndefinedError) as cm:
+            self._testme(['resources/name.j2', ':env'], '', stdin=stdin(), env=dict())
+        self.assertIn('$ j2 resources/name.j2 -- -:env', str(cm.exception))
+        # other data sources: no hint
+        with self.assertRaises(UndefinedError) as cm:
+            self._testme(['resources/name.j2', 'resources/data.json', ':env'], '', stdin=stdin(), env=dict())
+        self.assertNotIn('.env file', str(cm.exception))
+        # the suggested command works
+        self._testme(['resources/name.j2', '--', '-:env'], u'Hello Jürgen!\n', stdin=stdin())
 
     def test_jinja2_extensions(self):
         """ Test that an extension is enabled """
         with mktemp('{% do [] %}') as template:
             # `do` tag is an extension
-            self._testme([template], '')
+            self._testme([template, ':env'], '')
 
 
     def test_customize(self):
@@ -210,31 +408,114 @@ class RenderTest(unittest.TestCase):
         # Test: j2_environment_params()
         # Custom tag start/end
         with mktemp('<% if 1 %>1<% else %>2<% endif %>') as template:
-            self._testme(['--customize=resources/customize.py', template], '1')
+            self._testme(['--customize=resources/customize.py', template, ':env'], '1')
 
         # Test: j2_environment()
         # custom function: my_function
         with mktemp('<< my_function("hey") >>') as template:
-            self._testme(['--customize=resources/customize.py', template], 'my function says "hey"')
+            self._testme(['--customize=resources/customize.py', template, ':env'], 'my function says "hey"')
 
         # Test: alter_context()
         # Extra variable: ADD=127
         with mktemp('<< ADD >>') as template:
-            self._testme(['--customize=resources/customize.py', template], '127')
+            self._testme(['--customize=resources/customize.py', template, ':env'], '127')
 
         # Test: extra_filters()
         with mktemp('<< ADD|parentheses >>') as template:
-            self._testme(['--customize=resources/customize.py', template], '(127)')
+            self._testme(['--customize=resources/customize.py', template, ':env'], '(127)')
 
         # Test: extra_tests()
         with mktemp('<% if ADD|int is custom_odd %>odd<% endif %>') as template:
-            self._testme(['--customize=resources/customize.py', template], 'odd')
-
-        # reset
-        # otherwise it will load the same module even though its name has changed
-        del sys.modules['customize-module']
+            self._testme(['--customize=resources/customize.py', template, ':env'], 'odd')
 
         # Test: no hooks in a file
         # Got to restore to the original configuration and use {% %} again
         with mktemp('{% if 1 %}1{% endif %}') as template:
-            self._testme(['--customize=render-test.py', template], '1')
+            self._testme(['--customize=render-test.py', template, ':env'], '1')
+
+    def test_customize__readonly_params(self):
+        """ Test --customize with j2_environment_params() returning a read-only mapping """
+        customize = (
+            'import types\n'
+            'PARAMS = types.MappingProxyType(dict(variable_start_string="<<", variable_end_string=">>"))\n'
+            'def j2_environment_params():\n'
+            '    return PARAMS\n'
+        )
+        with mktemp(customize) as customize_file, mktemp('<< a >>') as template:
+            self._testme(['--customize=' + customize_file, template, ':env'], '1', env=dict(a='1'))
+
+    def test_bytecode_cache(self):
+        """ Test that cached templates are keyed on the settings they were compiled with """
+        cache_env = {BYTECODE_CACHE_ENVVAR: os.path.join(tmpdir, 'bytecode-cache')}
+        with mktemp('{% if 1 %}\n  x\n{% endif %}\n') as template:
+            # the second rendering of each variant is served from the cache
+            for _ in range(2):
+                self._testme([template, ':env'], '  x\n', env=cache_env)
+                self._testme(['--no-compact', template, ':env'], '\n  x\n\n', env=cache_env)
+        self.assertEqual(len(os.listdir(cache_env[BYTECODE_CACHE_ENVVAR])), 2)
+
+    def _testme_dependencies(self, argv, expected_output, stdin=None):
+        """ Run j2dep with the given arguments, and compare its output """
+        old_argv = sys.argv
+        sys.argv = ['j2dep'] + argv
+        try:
+            with mock_stdin(stdin), redirect_stdout(io.StringIO()) as out:
+                dependencies()
+        finally:
+            sys.argv = old_argv
+        self.assertEqual(out.getvalue(), expected_output)
+
+    def test_dependencies(self):
+        """ Test j2dep, analyzed serially, in parallel, and from stdin """
+        sources = ['{{% include "inc{0}.j2" %}}{{% extends "base.j2" %}}'.format(n)
+                   for n in range(DEPENDENCIES_PARALLEL_MIN + 1)]
+        expected = lambda f, n: "{0}\n['inc{1}.j2', 'base.j2']\n".format(f, n)
+        with ExitStack() as stack:
+            templates = [stack.enter_context(mktemp(source)) for source in sources]
+            # serially
+            few = templates[:DEPENDENCIES_PARALLEL_MIN - 1]
+            self._testme_dependencies(few, ''.join(expected(f, n) for n, f in enumerate(few)))
+            # in parallel - results in the order of the arguments
+            self._testme_dependencies(templates, ''.join(expected(f, n) for n, f in enumerate(templates)))
+            # stdin, alone and along with templates analyzed in parallel
+            def stdin():
+                buf = io.StringIO(sources[0])
+                buf.name = '<stdin>'
+                return buf
+            self._testme_dependencies(['-'], expected('<stdin>', 0), stdin=stdin())
+            self._testme_dependencies(templates + ['-'],
+                    ''.join(expected(f, n) for n, f in enumerate(templates)) + expected('<stdin>', 0),
+                    stdin=stdin())
+
+    def test_parse_data_spec__ctx_dst(self):
+        """ Test the ctx_dst part of data specifications """
+        # Not specified, or empty
+        self.assertEqual(parse_data_spec('data.json'), ('data.json', None, 'json'))
+        self.assertEqual(parse_data_spec('data:1.json::json'), ('data:1.json', None, 'json'))
+        self.assertEqual(parse_data_spec('::env'), (None, None, 'env'))
+        # Specified
+        self.assertEqual(parse_data_spec('data.json:nginx:json'), ('data.json', 'nginx', 'json'))
+        self.assertEqual(parse_data_spec(':nginx:env'), (None, 'nginx', 'env'))
+
+    def test_parse_data_spec__env(self):
+        """ Test data specifications that read the environment variables """
+        self.assertEqual(parse_data_spec(':env'), (None, None, 'env'))
+        self.assertEqual(parse_data_spec(':nginx:env'), (None, 'nginx', 'env'))
+        # a plain 'env' is a data file, in the fallback format
+        self.assertEqual(parse_data_spec('env'), ('env', None, 'ini'))
+        self.assertEqual(parse_data_spec('env', fallback_format='env'), ('env', None, 'env'))
+        # so is an empty location in the fallback format
+        self.assertEqual(parse_data_spec(':nginx', fallback_format='env'), (':nginx', None, 'env'))
+        # environment files are read from their location
+        self.assertEqual(parse_data_spec('data.env'), ('data.env', None, 'env'))
+        self.assertEqual(parse_data_spec('data:env'), ('data', None, 'env'))
+
+    def test_parse_data_spec__extension(self):
+        """ Test guessing the format from the file extension """
+        self.assertEqual(parse_data_spec('data.json'), ('data.json', None, 'json'))
+        # case-insensitive
+        self.assertEqual(parse_data_spec('DATA.JSON'), ('DATA.JSON', None, 'json'))
+        self.assertEqual(parse_data_spec('data.Yml'), ('data.Yml', None, 'yaml'))
+        self.assertEqual(parse_data_spec('data.Env'), ('data.Env', None, 'env'))
+        # unknown extensions use the fallback format
+        self.assertEqual(parse_data_spec('data.txt', fallback_format='json'), ('data.txt', None, 'json'))